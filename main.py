@@ -3,7 +3,8 @@ import threading
 from src.config import app, ARTICLES_DIR, IMAGES_DIR, DATA_DIR, logger
 from src.routes import run_web_server
 from src.mail_processor import process_message, check_mail_loop
-from src.cleanup import cleanup_old_articles, delete_article_data
+from src.cleanup import cleanup_old_articles, cleanup_loop, delete_article_data
+from src.articles import clear_ready_articles
 from src.instapaper import send_to_instapaper
 from src.image_utils import download_and_convert_thumbnail
 
@@ -13,13 +14,19 @@ import src.routes  # noqa: F401
 # --- MAIN ENTRY POINT ---
 if __name__ == "__main__":
     logger.info("Application starting up...")
-    # Initial cleanup
+    # Initial cleanup (read-ready copies are rebuilt on first read with the current API host)
+    clear_ready_articles()
     cleanup_old_articles()
     
     # Start web server in a separate thread
     t1 = threading.Thread(target=run_web_server)
     t1.daemon = True
     t1.start()
+
+    # Periodic cleanup in the background (keeps it off the mail path)
+    t2 = threading.Thread(target=cleanup_loop)
+    t2.daemon = True
+    t2.start()
     
     # Start mail listener
     check_mail_loop()
@@ -0,0 +1,355 @@
+import os
+import re
+import time
+import threading
+from contextlib import contextmanager
+
+import orjson
+
+from src.config import ARTICLES_DIR, DATA_DIR, READY_DIR, VDS_IP, is_article_filename, logger
+from src.utils import write_file_atomic, extract_snippet_from_html
+
+
+# --- PRECOMPILED PATTERNS ---
+# Existing og:/twitter: meta tags (stripped in one pass before re-injection)
+META_STRIP_RE = re.compile(r'<meta[^>]+(?:property=["\']og:|name=["\']twitter:)[^>]+>', re.IGNORECASE)
+DIV_RE = re.compile(r'<(/?)div', re.IGNORECASE)
+
+
+# Invariant pieces of the header link block (public URL and mail date go in between)
+HEADER_PREFIX = '''
+        <p style="
+            font-style: italic;
+            color: #666;
+            margin: 10px 0;
+            font-size: 0.9em;
+        ">
+            <a href="'''
+HEADER_MID = '''" target="_blank" style="color: #0066cc; text-decoration: underline;">makaleyi web sitesinde görüntüle</a>
+            <span style="margin-left: 8px; color: #999; font-size: 0.85em;">('''
+HEADER_SUFFIX = ''')</span>
+        </p>
+        '''
+
+
+# --- ARTICLE LISTING CACHE ---
+# Rebuilt only when the ARTICLES_DIR mtime changes (any file created/deleted)
+_articles_cache = {'mtime': None, 'set': frozenset(), 'sorted': []}
+
+
+def get_articles():
+    """Return (set of article filenames, filenames sorted newest first) using the cached listing"""
+    global _articles_cache
+    mtime = os.stat(ARTICLES_DIR).st_mtime_ns
+    cache = _articles_cache
+    if cache['mtime'] == mtime:
+        return cache['set'], cache['sorted']
+
+    files_with_time = []
+    with os.scandir(ARTICLES_DIR) as it:
+        for entry in it:
+            if is_article_filename(entry.name):
+                files_with_time.append((entry.name, entry.stat().st_ctime))
+    files_with_time.sort(key=lambda x: x[1], reverse=True)
+
+    names = [f for f, _ in files_with_time]
+    _articles_cache = {'mtime': mtime, 'set': frozenset(names), 'sorted': names}
+    return _articles_cache['set'], _articles_cache['sorted']
+
+
+def invalidate_articles_cache():
+    """Force the next get_articles() call to re-list ARTICLES_DIR"""
+    global _articles_cache
+    _articles_cache = {'mtime': None, 'set': frozenset(), 'sorted': []}
+
+
+# --- ARTICLE MAPPING CACHE ---
+# Parsed {uuid}.json mappings, reused while the file mtime is unchanged
+_mapping_cache = {}  # {uuid_name: (mtime_ns, mapping)}
+
+
+def load_mapping(uuid_name):
+    """Return the parsed JSON mapping of an article (None if it has none), cached by file mtime"""
+    json_path = os.path.join(DATA_DIR, f"{uuid_name}.json")
+    try:
+        mtime = os.stat(json_path).st_mtime_ns
+    except FileNotFoundError:
+        _mapping_cache.pop(uuid_name, None)
+        return None
+
+    cached = _mapping_cache.get(uuid_name)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(json_path, 'rb') as f:
+        mapping = orjson.loads(f.read())
+    _mapping_cache[uuid_name] = (mtime, mapping)
+    return mapping
+
+
+def invalidate_mapping(uuid_name):
+    """Drop a cached mapping (after its JSON file is deleted)"""
+    _mapping_cache.pop(uuid_name, None)
+
+
+# --- ARTICLE SNIPPET CACHE ---
+# Fallback descriptions for the index page, re-extracted only when the article file changes
+_snippet_cache = {}  # {(filename, max_length): (mtime_ns, snippet)}
+
+
+def get_article_snippet(filename, max_length=150):
+    """Plain-text snippet from the first paragraph of an article, cached by file mtime"""
+    path = os.path.join(ARTICLES_DIR, filename)
+    mtime = os.stat(path).st_mtime_ns
+    key = (filename, max_length)
+    cached = _snippet_cache.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'r', encoding='utf-8') as f:
+        snippet = extract_snippet_from_html(f.read(), max_length=max_length)
+    _snippet_cache[key] = (mtime, snippet)
+    return snippet
+
+
+def invalidate_snippets(filename):
+    """Drop cached snippets of a deleted article"""
+    for key in [k for k in _snippet_cache if k[0] == filename]:
+        _snippet_cache.pop(key, None)
+
+
+# --- ARTICLE INDEX ---
+# {uuid_name: {'ctime': float, 'images': frozenset}} - built from disk once, then updated
+# on save/delete so cleanup needs neither a directory scan nor JSON parsing
+_articles_index = None
+_index_lock = threading.Lock()
+
+
+def get_mapping_images(mapping):
+    """Local image filenames referenced by a mapping (og thumbnail + body images)"""
+    images = set(mapping.get('body_mappings', {}).values())
+    if mapping.get('og_image_local'):
+        images.add(mapping['og_image_local'])
+    return frozenset(images)
+
+
+def build_articles_index():
+    """Scan ARTICLES_DIR and the mappings once to build the article index"""
+    index = {}
+    with os.scandir(ARTICLES_DIR) as it:
+        for entry in it:
+            if not is_article_filename(entry.name):
+                continue
+            uuid_name = entry.name[:-len('.html')]
+            try:
+                mapping = load_mapping(uuid_name)
+            except Exception as e:
+                logger.error(f"Mapping read error ({uuid_name}): {e}")
+                mapping = None
+            index[uuid_name] = {
+                'ctime': entry.stat().st_ctime,
+                'images': get_mapping_images(mapping) if mapping else frozenset(),
+            }
+    return index
+
+
+def get_articles_index():
+    """Return a snapshot of the article index, building it on first use"""
+    global _articles_index
+    with _index_lock:
+        if _articles_index is None:
+            _articles_index = build_articles_index()
+        return dict(_articles_index)
+
+
+def index_article(uuid_name, mapping):
+    """Add a newly saved article to the index"""
+    with _index_lock:
+        if _articles_index is not None:
+            _articles_index[uuid_name] = {'ctime': time.time(), 'images': get_mapping_images(mapping)}
+
+
+def unindex_article(uuid_name):
+    """Remove an article from the index, returning its entry (None if it was not indexed)"""
+    with _index_lock:
+        if _articles_index is None:
+            return None
+        return _articles_index.pop(uuid_name, None)
+
+
+# --- INGEST / CLEANUP GUARD ---
+# A message being processed can reuse images of indexed articles (dedup / URL cache hits)
+# before it is indexed itself, so cleanup must not run while messages are in flight
+_guard_cond = threading.Condition()
+_active_ingests = 0
+_cleanup_running = False
+
+
+@contextmanager
+def article_ingest():
+    """Shared guard held while a message is turned into an article"""
+    global _active_ingests
+    with _guard_cond:
+        _guard_cond.wait_for(lambda: not _cleanup_running)
+        _active_ingests += 1
+    try:
+        yield
+    finally:
+        with _guard_cond:
+            _active_ingests -= 1
+            _guard_cond.notify_all()
+
+
+@contextmanager
+def article_cleanup():
+    """Exclusive guard for deleting articles; new ingests wait until it is released"""
+    global _cleanup_running
+    with _guard_cond:
+        _guard_cond.wait_for(lambda: not _cleanup_running)
+        _cleanup_running = True  # Blocks new ingests while the running ones finish
+        _guard_cond.wait_for(lambda: _active_ingests == 0)
+    try:
+        yield
+    finally:
+        with _guard_cond:
+            _cleanup_running = False
+            _guard_cond.notify_all()
+
+
+# --- READ-READY ARTICLE RENDERING ---
+def get_ready_filename(filename):
+    """Name of the post-processed copy of an article (served as a static file)"""
+    return filename.replace('.html', '.ready.html')
+
+
+def clear_ready_articles():
+    """Delete all read-ready copies: they embed VDS_IP, which may have changed since the last run"""
+    with os.scandir(READY_DIR) as it:
+        for entry in it:
+            if entry.is_file():
+                os.remove(entry.path)
+
+
+def render_article(filename, content, mapping):
+    """Apply the e-reader rewrites, OG metadata and header link to the original article HTML"""
+    # --- PUBLIC LINK INJECTION ---
+    public_url = f"{VDS_IP}/read/{filename}"
+
+    # --- DIV TO P REPLACEMENT (E-Reader Compatibility) ---
+    content = DIV_RE.sub(r'<\1p', content)
+    logger.debug("DIV tags replaced with P tags.")
+
+    # --- DYNAMIC OG METADATA INJECTION (VIA JSON) ---
+    if mapping:
+        og_tags = []
+        
+        # 1. og:image
+        og_local = mapping.get('og_image_local')
+        if og_local:
+            local_img_url = f"{VDS_IP}/images/{og_local}"
+            og_tags.append(f'<meta property="og:image" content="{local_img_url}">')
+            og_tags.append(f'<meta name="twitter:image" content="{local_img_url}">')
+            logger.debug(f"og:image injected: {og_local}")
+
+        # 2. Other Metadata
+        for key in ['og:title', 'og:description', 'og:type', 'og:url']:
+            val = mapping.get(key.replace(':', '_'))
+            if val:
+                og_tags.append(f'<meta property="{key}" content="{val}">')
+        
+        if og_tags:
+            og_html = "\n".join(og_tags)
+            # Clean existing og/twitter tags to prevent conflicts
+            content = META_STRIP_RE.sub('', content)
+            
+            # Injection
+            if '<head>' in content:
+                content = content.replace('<head>', f'<head>{og_html}', 1)
+            elif '<html>' in content:
+                content = content.replace('<html>', f'<html><head>{og_html}</head>', 1)
+            else:
+                content = f'{og_html}' + content
+
+        # 3. Body Image Replacement (Existing logic)
+        body_maps = mapping.get('body_mappings', {})
+        if body_maps:
+            # Single pass over the HTML for all mapped URLs (either quote style)
+            url_sub_re = re.compile(
+                r'src=(["\'])(' + '|'.join(re.escape(u) for u in body_maps) + r')\1'
+            )
+            content = url_sub_re.sub(
+                lambda m: f'src={m.group(1)}{VDS_IP}/images/{body_maps[m.group(2)]}{m.group(1)}',
+                content
+            )
+            logger.debug(f"{len(body_maps)} body image(s) replaced with local links.")
+
+    # --- FOOTER/HEADER LINK INJECTION ---
+
+    # Read mail date from JSON
+    date_str = mapping.get('mail_date', '')
+    
+    header_html = ''.join((HEADER_PREFIX, public_url, HEADER_MID, date_str, HEADER_SUFFIX))
+
+    # Injection Logic:
+    # 1. Find first </h2> tag and add after it
+    # 2. If no H2, find first <p> tag and add before it
+    # 3. If none found, add to body start
+
+    # Plain find + slice: the guards are case-sensitive, so the splice point is too
+    h2_idx = content.find('</h2>')
+    p_idx = content.find('<p') if h2_idx == -1 else -1
+    if h2_idx != -1:
+        h2_end = h2_idx + len('</h2>')
+        content = content[:h2_end] + header_html + content[h2_end:]
+        logger.debug("Link added after H2.")
+    elif p_idx != -1:
+        content = content[:p_idx] + header_html + content[p_idx:]
+        logger.debug("Link added before first P.")
+    elif '<body>' in content:
+        content = content.replace('<body>', f'<body>{header_html}', 1)
+    else:
+        content = header_html + content
+
+    return content
+
+
+def write_ready_article(filename, content, mapping):
+    """Render an article once and store the read-ready copy in READY_DIR"""
+    ready_path = os.path.join(READY_DIR, get_ready_filename(filename))
+    write_file_atomic(ready_path, render_article(filename, content, mapping).encode('utf-8'))
+    return ready_path
+
+
+def build_ready_article(filename):
+    """(Re)build the read-ready copy from the stored original HTML and JSON mapping"""
+    with open(os.path.join(ARTICLES_DIR, filename), 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    uuid_name = filename.replace('.html', '')
+    try:
+        mapping = load_mapping(uuid_name) or {}
+    except Exception:
+        mapping = {}
+
+    return write_ready_article(filename, content, mapping)
+
+
+def ensure_ready_article(filename):
+    """Build the read-ready copy if it is missing or older than the original HTML or its mapping"""
+    ready_path = os.path.join(READY_DIR, get_ready_filename(filename))
+    try:
+        ready_mtime = os.stat(ready_path).st_mtime_ns
+    except FileNotFoundError:
+        return build_ready_article(filename)
+
+    sources = (
+        os.path.join(ARTICLES_DIR, filename),
+        os.path.join(DATA_DIR, f"{filename.replace('.html', '')}.json"),
+    )
+    for source in sources:
+        try:
+            if os.stat(source).st_mtime_ns > ready_mtime:
+                return build_ready_article(filename)
+        except FileNotFoundError:
+            continue
+    return ready_path
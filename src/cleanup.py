@@ -1,10 +1,24 @@
 import os
-import json
+import time
 
-from src.config import ARTICLES_DIR, DATA_DIR, IMAGES_DIR, MAX_ARTICLES, UUID_PATTERN, logger
+from src.config import ARTICLES_DIR, DATA_DIR, IMAGES_DIR, READY_DIR, MAX_ARTICLES, CLEANUP_INTERVAL, logger
+from src.articles import (
+    invalidate_articles_cache, get_ready_filename, load_mapping, invalidate_mapping,
+    get_articles_index, unindex_article, get_mapping_images, invalidate_snippets, article_cleanup
+)
+from src.image_utils import forget_url_files, save_url_cache
 
 
 # --- CLEANUP FUNCTIONS ---
+def get_images_in_use(exclude_uuid=None):
+    """Collect local image filenames referenced by indexed articles (images are shared via dedup)"""
+    in_use = set()
+    for uuid_name, entry in get_articles_index().items():
+        if uuid_name != exclude_uuid:
+            in_use.update(entry['images'])
+    return in_use
+
+
 def delete_article_data(filename):
     """Delete all data associated with an article (HTML, JSON, Images)"""
     try:
@@ -12,30 +26,44 @@ def delete_article_data(filename):
         json_path = os.path.join(DATA_DIR, f"{uuid_name}.json")
         html_path = os.path.join(ARTICLES_DIR, filename)
 
-        # 1. Delete images referenced in JSON
+        # 1. Delete images referenced by the article (from the index, JSON only as a fallback)
+        get_articles_index()  # Make sure the index exists before removing the entry
+        entry = unindex_article(uuid_name)
+        if entry is not None:
+            images = entry['images']
+        else:
+            mapping = load_mapping(uuid_name)
+            images = get_mapping_images(mapping) if mapping else frozenset()
+
+        # Keep images that other articles still reference (cross-article dedup)
+        in_use = get_images_in_use(exclude_uuid=uuid_name)
+        removed = set()
+        for local_img in images:
+            if local_img in in_use:
+                continue
+            img_p = os.path.join(IMAGES_DIR, local_img)
+            if os.path.exists(img_p): os.remove(img_p)
+            removed.add(local_img)
+
+        # Removed images must no longer be served from the URL cache
+        forget_url_files(removed)
+        save_url_cache()
+
+        # Delete JSON file
         if os.path.exists(json_path):
-            with open(json_path, 'r', encoding='utf-8') as f:
-                mapping = json.load(f)
-            
-            # Delete og_image
-            og_local = mapping.get('og_image_local')
-            if og_local:
-                img_p = os.path.join(IMAGES_DIR, og_local)
-                if os.path.exists(img_p): os.remove(img_p)
-            
-            # Delete body images
-            body_maps = mapping.get('body_mappings', {})
-            for local_img in body_maps.values():
-                img_p = os.path.join(IMAGES_DIR, local_img)
-                if os.path.exists(img_p): os.remove(img_p)
-            
-            # Delete JSON file
             os.remove(json_path)
+            invalidate_mapping(uuid_name)
             logger.info(f"JSON and local images deleted: {uuid_name}.json")
 
-        # 2. Delete HTML file
+        # 2. Delete read-ready copy and HTML file
+        ready_path = os.path.join(READY_DIR, get_ready_filename(filename))
+        if os.path.exists(ready_path):
+            os.remove(ready_path)
+
         if os.path.exists(html_path):
             os.remove(html_path)
+            invalidate_articles_cache()
+            invalidate_snippets(filename)
             logger.info(f"Article deleted: {filename}")
             
     except Exception as e:
@@ -45,23 +73,27 @@ def delete_article_data(filename):
 def cleanup_old_articles():
     """Delete oldest articles when count exceeds limit"""
     try:
-        # Get all HTML files
-        files = [f for f in os.listdir(ARTICLES_DIR) if f.endswith('.html') and UUID_PATTERN.match(f)]
-        
-        if len(files) > MAX_ARTICLES:
-            # Sort files by creation time (oldest first)
-            files_with_time = []
-            for f in files:
-                file_path = os.path.join(ARTICLES_DIR, f)
-                files_with_time.append((f, os.path.getctime(file_path)))
-            
-            files_with_time.sort(key=lambda x: x[1])
-            
-            # Delete excess articles
-            files_to_delete = len(files) - MAX_ARTICLES
-            for i in range(files_to_delete):
-                delete_article_data(files_with_time[i][0])
-            
-            logger.info(f"{files_to_delete} old article(s) and their data cleaned up.")
+        # Wait for in-flight messages: they may already reference images of the oldest articles
+        with article_cleanup():
+            # Articles with their creation time, from the in-memory index
+            index = get_articles_index()
+
+            if len(index) > MAX_ARTICLES:
+                # Sort articles by creation time (oldest first)
+                oldest = sorted(index, key=lambda uuid_name: index[uuid_name]['ctime'])
+
+                # Delete excess articles
+                files_to_delete = len(index) - MAX_ARTICLES
+                for uuid_name in oldest[:files_to_delete]:
+                    delete_article_data(f"{uuid_name}.html")
+
+                logger.info(f"{files_to_delete} old article(s) and their data cleaned up.")
     except Exception as e:
         logger.error(f"Cleanup error: {e}")
+
+
+def cleanup_loop():
+    """Run cleanup_old_articles periodically (background thread, off the mail-processing path)"""
+    while True:
+        time.sleep(CLEANUP_INTERVAL)
+        cleanup_old_articles()
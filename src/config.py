@@ -9,14 +9,28 @@ TR_TZ = timezone(timedelta(hours=3))
 
 # --- LOAD SETTINGS FROM .ENV FILE ---
 from dotenv import load_dotenv
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
 # --- LOGGING SETUP ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+# Records are queued by the calling thread and written by a listener thread,
+# so download/processing workers never block on stdout.
+# LOG_LEVEL=DEBUG shows per-image details.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter(
+    '%(asctime)s - %(levelname)s - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
-)
+))
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_log_handler = QueueHandler(_log_queue)
+_log_handler.setFormatter(logging.Formatter('%(message)s'))  # Final formatting happens in _log_stream
+logging.basicConfig(level=LOG_LEVEL, handlers=[_log_handler])
 logger = logging.getLogger('kobo-helper')
 
 # --- CONFIGURATION ---
@@ -24,7 +38,11 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 ARTICLES_DIR = os.path.join(BASE_DIR, "articles")
 IMAGES_DIR = os.path.join(BASE_DIR, "images")
 DATA_DIR = os.path.join(BASE_DIR, "data")
+# Derived files live in subfolders (inside the mounted volumes, but out of the dashboard counts)
+READY_DIR = os.path.join(ARTICLES_DIR, "ready")  # Read-ready article copies
+CACHE_DIR = os.path.join(DATA_DIR, "cache")  # Persistent caches (URL cache)
 MAX_ARTICLES = 50  # Maximum number of articles
+CLEANUP_INTERVAL = 300  # Seconds between background cleanup runs
 
 IMAP_SERVER = os.getenv("IMAP_SERVER")
 EMAIL_USER = os.getenv("EMAIL_USER")
@@ -35,6 +53,8 @@ VDS_IP = os.getenv("API")
 
 raw_port = os.getenv("PORT", "5030")
 WEB_PORT = int(raw_port) if raw_port and raw_port.strip() else 5030
+WEB_THREADS = 16  # Concurrent request threads for the WSGI server
+THUMB_FORMAT = os.getenv("THUMB_FORMAT", "PNG").strip().upper()  # Graphic thumbnails: PNG or WEBP
 
 if not os.path.exists(ARTICLES_DIR):
     os.makedirs(ARTICLES_DIR)
@@ -42,9 +62,24 @@ if not os.path.exists(IMAGES_DIR):
     os.makedirs(IMAGES_DIR)
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
+if not os.path.exists(READY_DIR):
+    os.makedirs(READY_DIR)
+if not os.path.exists(CACHE_DIR):
+    os.makedirs(CACHE_DIR)
 
 # UUID format regex pattern
 UUID_PATTERN = re.compile(r'^[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}\.html$')
+_UUID_CHARS = frozenset('0123456789abcdef-')
+
+
+def is_article_filename(name):
+    """Structural equivalent of UUID_PATTERN (lowercase UUID + .html) using plain string checks"""
+    return (
+        len(name) == 41 and name.endswith('.html')
+        and name[8] == name[13] == name[18] == name[23] == '-'
+        and name.count('-') == 4
+        and _UUID_CHARS.issuperset(name[:36])
+    )
 
 # Flask application
 app = Flask(__name__, 
@@ -2,22 +2,75 @@ import os
 import re
 import io
 import uuid
+import hashlib
+import threading
 import requests
-import numpy as np
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict
 import imagehash
-from PIL import Image
+from PIL import Image, ImageChops, ImageStat
 
-from src.config import IMAGES_DIR, logger
+from src.config import IMAGES_DIR, CACHE_DIR, THUMB_FORMAT, logger
+from src.utils import write_file_atomic
+
+# --- HTTP SESSION ---
+# Keep-alive pool shared by all image downloads (newsletters pull many images from one CDN)
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = 'Mozilla/5.0'
+_adapter = HTTPAdapter(
+    pool_connections=16, pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+)
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
 
 # --- IMAGE FILTERING HELPERS ---
-seen_hashes = {}  # Duplicate detection: {hash: filename}
+seen_hashes = {}  # Duplicate detection: {target_format: OrderedDict((hash_int, w, h): (filename, pixels))} (LRU)
+MAX_SEEN_HASHES = 2_000  # Per-format LRU bound, kept across messages (each entry holds a 4 KB thumbnail)
+_hash_lock = threading.Lock()  # seen_hashes is shared by the parallel download workers
+MAX_PIXEL_DIFF = 16  # Max per-pixel gap between the analysis thumbnails of a hash hit
+# Encoder settings: thumbnails are viewed once on an e-reader, so favour encode speed
+JPEG_SAVE_OPTIONS = {'quality': 82, 'optimize': False, 'progressive': False}
+PHOTO_SAVE_OPTIONS = {'quality': 85, 'progressive': True}
+PNG_SAVE_OPTIONS = {'optimize': False, 'compress_level': 1}
+WEBP_SAVE_OPTIONS = {'quality': 80, 'method': 1}
+# Saved images are capped to what the e-reader can show (Kobo screens are ~1072x1448)
+BODY_MAX_SIZE = (1200, 1600)  # Body images (JPEG target)
+THUMB_MAX_SIZE = (400, 400)  # Cover thumbnails (PNG target)
+# Formats we convert; anything else (SVG, ICO, HTML error pages...) never reaches Pillow
+SUPPORTED_IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF')
+REJECTED_CONTENT_TYPES = ('svg', 'icon', 'text/', 'application/json')
+MIN_IMAGE_BYTES = 2048  # Smaller payloads without a parseable header are icons / tracking pixels
+MAX_IMAGE_BYTES = 10 * 1024 * 1024  # Larger downloads are aborted
+MAX_HEADER_PROBE_BYTES = 256 * 1024  # Stop looking for the image header after this much data
+ANALYSIS_SIZE = (64, 64)  # The dHash and hit confirmation run on a grayscale thumbnail of this size
+
+
+def get_gray_image(img):
+    """Grayscale copy at decoded (drafted) size, cached on the image object"""
+    gray = getattr(img, '_gray_img', None)
+    if gray is None:
+        gray = img if img.mode == "L" else img.convert("L")
+        img._gray_img = gray
+    return gray
+
+
+def get_analysis_image(img):
+    """Small BOX-averaged grayscale copy used for the hash, cached on the image object"""
+    small = getattr(img, '_analysis_img', None)
+    if small is None:
+        small = get_gray_image(img).resize(ANALYSIS_SIZE, Image.BOX)
+        img._analysis_img = small
+    return small
 
 
 def is_low_color_variance(img, threshold=5):
     """Check for single-color / blank images"""
     try:
-        arr = np.array(img.convert("L"))
-        return arr.std() < threshold
+        # Not on the BOX thumbnail: averaging flattens thin lines and noise below the threshold
+        return ImageStat.Stat(get_gray_image(img)).stddev[0] < threshold
     except Exception:
         return False
 
@@ -29,15 +82,21 @@ def is_bad_aspect_ratio(width, height, min_ratio=0.1, max_ratio=10):
     return ratio < min_ratio or ratio > max_ratio
 
 
-def get_html_attr_val(tag, attr):
-    """Extract attribute value (px) from an HTML tag"""
-    # Normal attribute: width="40"
-    m = re.search(rf'{attr}=["\'](\d+)', tag, re.IGNORECASE)
-    if m: return int(m.group(1))
-    # Style attribute: width: 40px
-    m = re.search(rf'{attr}:\s*(\d+)px', tag, re.IGNORECASE)
-    if m: return int(m.group(1))
-    return None
+# Dimension in either form: width="40" (attribute) / width: 40px (style)
+HTML_DIM_RE = re.compile(r'(width|height)(?:=["\'](\d+)|:\s*(\d+)px)', re.IGNORECASE)
+
+
+def get_html_dimensions(tag):
+    """Extract (width, height) in px from an HTML tag in a single scan; attributes win over styles"""
+    attrs = {}
+    styles = {}
+    for m in HTML_DIM_RE.finditer(tag):
+        dim = m.group(1).lower()
+        if m.group(2) is not None:
+            attrs.setdefault(dim, int(m.group(2)))
+        else:
+            styles.setdefault(dim, int(m.group(3)))
+    return attrs.get('width', styles.get('width')), attrs.get('height', styles.get('height'))
 
 
 def is_avatar_tag(full_tag):
@@ -47,14 +106,18 @@ def is_avatar_tag(full_tag):
         return True
     
     # 2. Small display size (width/height < 100)
-    w = get_html_attr_val(full_tag, "width")
-    h = get_html_attr_val(full_tag, "height")
+    w, h = get_html_dimensions(full_tag)
     if (w is not None and w < 100) or (h is not None and h < 100):
         return True
         
     return False
 
 
+def is_photo_like(img, max_graphic_colors=256):
+    """Opaque images with more than a palette's worth of colors are treated as photos"""
+    return img.getcolors(maxcolors=max_graphic_colors) is None
+
+
 def is_overcompressed(file_size, width, height, threshold=0.01):
     """Check for over-compression (low quality/corrupted images)"""
     pixel_count = width * height
@@ -62,38 +125,154 @@ def is_overcompressed(file_size, width, height, threshold=0.01):
     return (file_size / pixel_count) < threshold
 
 
-def is_duplicate(img, target_format):
-    """Image similarity check (Hash + Format based)"""
-    try:
-        img_hash = str(imagehash.phash(img))
-        # Was the same image already processed in this format?
-        cache_key = f"{img_hash}_{target_format}"
-        return seen_hashes.get(cache_key)
-    except Exception:
+def compute_image_hash(img):
+    """Compute the difference hash (dHash) of an image as a 64-bit int, cached on the image object"""
+    img_hash = getattr(img, '_img_hash', None)
+    if img_hash is None:
+        # dHash: 9x8 grayscale gradient signs - as stable as pHash for re-encodes, without the DCT
+        img_hash = int(str(imagehash.dhash(get_analysis_image(img))), 16)
+        img._img_hash = img_hash
+    return img_hash
+
+
+def is_duplicate_by_hash(analysis_img, img_hash, width, height, target_format, max_diff=MAX_PIXEL_DIFF):
+    """Image identity check (exact hash and source dimensions, same format, matching thumbnails)"""
+    # No Hamming-distance matching: hits are reused across mails, and even exact 64-bit
+    # matches can be different text-on-white cards, so the thumbnails are compared too
+    match = (img_hash, width, height)
+    with _hash_lock:
+        # Was the same image (e.g. re-served under another URL) already processed in this format?
+        format_hashes = seen_hashes.get(target_format)
+        if not format_hashes or match not in format_hashes:
+            return None
+        filename, pixels = format_hashes[match]
+
+    seen_img = Image.frombytes("L", ANALYSIS_SIZE, pixels)
+    if ImageChops.difference(analysis_img, seen_img).getextrema()[1] > max_diff:
         return None
 
+    with _hash_lock:
+        # The file may have been removed by cleanup since it was registered
+        if not os.path.exists(os.path.join(IMAGES_DIR, filename)):
+            format_hashes.pop(match, None)
+            return None
+        if match in format_hashes:
+            format_hashes.move_to_end(match)
+        return filename
+
+
+def register_image_hash_value(analysis_img, img_hash, width, height, filename, target_format):
+    """Register image hash, source size and thumbnail with its format, evicting the least recently used entries"""
+    key = (img_hash, width, height)
+    pixels = analysis_img.tobytes()
+    with _hash_lock:
+        format_hashes = seen_hashes.setdefault(target_format, OrderedDict())
+        format_hashes[key] = (filename, pixels)
+        format_hashes.move_to_end(key)
+        while len(format_hashes) > MAX_SEEN_HASHES:
+            format_hashes.popitem(last=False)
 
-def register_image_hash(img, filename, target_format):
-    """Register image hash with its format"""
+
+# --- PERSISTENT URL CACHE ---
+# {sha1(url)_format: filename} - skips download/decode for images saved by earlier mails
+URL_CACHE_PATH = os.path.join(CACHE_DIR, 'url_cache.json')
+_url_cache_lock = threading.Lock()
+_url_cache_dirty = False  # In-memory changes not yet written (flushed once per message / cleanup)
+
+
+def load_url_cache():
+    """Load the URL cache from disk, dropping entries whose image file no longer exists"""
     try:
-        img_hash = str(imagehash.phash(img))
-        cache_key = f"{img_hash}_{target_format}"
-        seen_hashes[cache_key] = filename
-    except Exception:
-        pass
+        with open(URL_CACHE_PATH, 'rb') as f:
+            cache = orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"URL cache load error: {e}")
+        return {}
+    return {k: v for k, v in cache.items() if os.path.exists(os.path.join(IMAGES_DIR, v))}
+
+
+URL_CACHE = load_url_cache()
+
+
+def get_url_cache_key(img_url, target_format):
+    return f"{hashlib.sha1(img_url.encode('utf-8')).hexdigest()}_{target_format}"
+
+
+def get_cached_url_file(img_url, target_format):
+    """Return the saved filename for this URL/format if it is still on disk"""
+    key = get_url_cache_key(img_url, target_format)
+    global _url_cache_dirty
+    filename = URL_CACHE.get(key)
+    if filename and not os.path.exists(os.path.join(IMAGES_DIR, filename)):
+        with _url_cache_lock:
+            URL_CACHE.pop(key, None)
+            _url_cache_dirty = True
+        return None
+    return filename
+
+
+def register_url_file(img_url, target_format, filename):
+    """Record a saved image for its URL/format (written to disk by save_url_cache)"""
+    global _url_cache_dirty
+    with _url_cache_lock:
+        URL_CACHE[get_url_cache_key(img_url, target_format)] = filename
+        _url_cache_dirty = True
+
+
+def forget_url_files(filenames):
+    """Drop the cache entries pointing at deleted image files"""
+    global _url_cache_dirty
+    if not filenames:
+        return
+    with _url_cache_lock:
+        stale = [k for k, v in URL_CACHE.items() if v in filenames]
+        for key in stale:
+            del URL_CACHE[key]
+        if stale:
+            _url_cache_dirty = True
+
+
+def save_url_cache():
+    """Flush the URL cache atomically if it changed since the last save"""
+    global _url_cache_dirty
+    with _url_cache_lock:
+        if not _url_cache_dirty:
+            return
+        try:
+            write_file_atomic(URL_CACHE_PATH, orjson.dumps(URL_CACHE))
+            _url_cache_dirty = False
+        except Exception as e:
+            logger.error(f"URL cache save error: {e}")
 
 
 # --- THUMBNAIL PROCESSING FUNCTIONS ---
+def compile_meta_patterns(property_name):
+    """(property-first, content-first) patterns for a meta tag, in flexible attribute order"""
+    name = re.escape(property_name)
+    return (
+        re.compile(r'<meta[^>]+(?:property|name)=["\']' + name + r'["\'][^>]+content=["\']([^"\']+)["\']', re.IGNORECASE),
+        re.compile(r'<meta[^>]+content=["\']([^"\']+)["\'][^>]+(?:property|name)=["\']' + name + r'["\']', re.IGNORECASE),
+    )
+
+
+OG_IMAGE_TAGS = ('og:image', 'twitter:image', 'image', 'thumbnail')
+
+# Precompiled patterns for every meta tag the mail processor asks for
+META_PATTERNS = {
+    name: compile_meta_patterns(name)
+    for name in ('og:title', 'og:description', 'og:type', 'og:url') + OG_IMAGE_TAGS
+}
+
+
 def extract_meta_tag(content, property_name):
     """Extract specified meta tag value from HTML content (regardless of property or name)"""
     # Search for tags containing property="..." or name="..." in flexible order
-    patterns = [
-        r'<meta[^>]+(?:property|name)=["\']' + re.escape(property_name) + r'["\'][^>]+content=["\']([^"\']+)["\']',
-        r'<meta[^>]+content=["\']([^"\']+)["\'][^>]+(?:property|name)=["\']' + re.escape(property_name) + r'["\']'
-    ]
+    patterns = META_PATTERNS.get(property_name) or compile_meta_patterns(property_name)
     
     for pattern in patterns:
-        match = re.search(pattern, content, re.IGNORECASE)
+        match = pattern.search(content)
         if match:
             val = match.group(1).strip()
             if val: return val
@@ -102,81 +281,237 @@ def extract_meta_tag(content, property_name):
 
 def extract_og_image(content):
     """Extract og:image or alternative thumbnail tags from HTML content"""
-    for tag in ['og:image', 'twitter:image', 'image', 'thumbnail']:
+    for tag in OG_IMAGE_TAGS:
         url = extract_meta_tag(content, tag)
         if url: return url
     return None
 
 
-def download_and_convert_thumbnail(img_url, target_format='PNG'):
-    """Download image, convert to specified format, save with UUID and return new path"""
+def has_acceptable_size(width, height):
+    """Dimension rules that can be decided from the image header alone"""
+    return width >= 100 and height >= 100 and not is_bad_aspect_ratio(width, height)
+
+
+def sniff_image_format(head):
+    """Identify a supported image format from its first 12 bytes (None if unsupported)"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    return None
+
+
+def probe_image_header(buf):
+    """
+    Parse (format, width, height) from a possibly incomplete download buffer, None if not yet possible.
+    Reads the BytesIO in place (no copy) and leaves its position at the end for further writes.
+    Note: ImageFile.Parser is not used here - it allocates the full-size pixel buffer as soon
+    as the header parses, which is wasted for every image we end up rejecting.
+    """
     try:
-        logger.info(f"Downloading image: {img_url} (Target: {target_format})")
-        response = requests.get(img_url, timeout=10, headers={'User-Agent': 'Mozilla/5.0'})
+        buf.seek(0)
+        with Image.open(buf, formats=SUPPORTED_IMAGE_FORMATS) as img:
+            return img.format, img.width, img.height
+    except Exception:
+        return None
+    finally:
+        buf.seek(0, io.SEEK_END)
+
+
+def fetch_image_bytes(img_url, max_bytes=MAX_IMAGE_BYTES, accept_size=None):
+    """
+    Stream an image into memory, giving up once it exceeds max_bytes.
+    If accept_size(width, height) is given, it is checked as soon as the image header
+    has arrived and the download stops early when it returns False.
+    Returns (data, content_type, header); data is None if the download was abandoned,
+    header is (format, width, height) once known.
+    """
+    with SESSION.get(img_url, timeout=10, stream=True) as response:
         response.raise_for_status()
-        
-        # Open image with Pillow
-        img = Image.open(io.BytesIO(response.content))
-        orig_format = img.format # PNG, JPEG, etc.
-        
-        width, height = img.size
-        logger.info(f"Image size: {width}x{height} ({orig_format})")
+        content_type = response.headers.get('Content-Type')
+
+        # Reject from the header when the server announces the size
+        content_length = response.headers.get('Content-Length', '')
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            logger.warning(f"Image too large ({content_length} bytes), skipping download.")
+            return None, content_type, None
+
+        # Reject non-raster responses before downloading the body
+        if content_type and any(t in content_type.lower() for t in REJECTED_CONTENT_TYPES):
+            logger.warning(f"Unsupported content type ({content_type}), skipping.")
+            return None, content_type, None
+
+        buf = io.BytesIO()
+        header = None
+        sniffed = False
+        for chunk in response.iter_content(65536):
+            buf.write(chunk)
+            if buf.tell() > max_bytes:
+                logger.warning(f"Image exceeded {max_bytes} bytes while downloading, aborting.")
+                return None, content_type, header
+
+            # Check the magic bytes once the first 12 bytes are in
+            if not sniffed and buf.tell() >= 12:
+                sniffed = True
+                if sniff_image_format(buf.getvalue()[:12]) is None:
+                    logger.warning(f"Unsupported image data ({content_type}), skipping.")
+                    return None, content_type, None
+
+            # Decide on dimensions before the rest of the body is transferred
+            if accept_size is not None and header is None and buf.tell() <= MAX_HEADER_PROBE_BYTES:
+                header = probe_image_header(buf)
+                if header and not accept_size(header[1], header[2]):
+                    return None, content_type, header
+        return buf.getvalue(), content_type, header
+
+
+def get_graphic_save_params():
+    """(format, save options, extension) for non-photo thumbnails, per THUMB_FORMAT"""
+    if THUMB_FORMAT == 'WEBP':
+        return 'WEBP', WEBP_SAVE_OPTIONS, "webp"
+    return 'PNG', PNG_SAVE_OPTIONS, "png"
+
+
+def fetch_thumbnail(img_url, target_format='PNG'):
+    """
+    Download stage (I/O bound): URL cache lookup, streamed download and header-level checks.
+    Returns (result, source): result is the final (filename, orig_format) when no decode is needed,
+    otherwise None and source is (data, orig_format, width, height) for convert_thumbnail().
+    """
+    try:
+        cached_file = get_cached_url_file(img_url, target_format)
+        if cached_file:
+            logger.debug(f"Image already saved from this URL as {target_format} ({cached_file}), reusing.")
+            return (cached_file, None), None
+
+        logger.debug(f"Downloading image: {img_url} (Target: {target_format})")
+        data, content_type, header = fetch_image_bytes(img_url, accept_size=has_acceptable_size)
+        if data is None and (header is None or has_acceptable_size(header[1], header[2])):
+            return (None, None), None  # Too large - keep the original link
+
+        # --- 0️⃣ PAYLOAD SIZE CHECK (before any Pillow call) ---
+        # Only when streaming found no header: small but parseable images (e.g. flat PNG charts)
+        # are judged by their dimensions, and tiny icons were already rejected from the header
+        if header is None and len(data) < MIN_IMAGE_BYTES:
+            logger.warning(f"Image payload too small ({len(data)} bytes), skipping.")
+            return (None, sniff_image_format(data[:12])), None
+
+        # Header parsed while streaming; otherwise let Pillow read it (raises on non-images)
+        if header is None:
+            with Image.open(io.BytesIO(data), formats=SUPPORTED_IMAGE_FORMATS) as probe:
+                header = probe.format, probe.width, probe.height
+        orig_format, width, height = header # PNG, JPEG, etc.
+        logger.debug(f"Image size: {width}x{height} ({orig_format})")
         
         # --- 1️⃣ SIZE CHECK (100px rule) ---
         if width < 100 or height < 100:
             logger.warning(f"Image too small ({width}x{height}), skipping.")
-            return None, orig_format
+            return (None, orig_format), None
             
         # --- 2️⃣ ASPECT RATIO CHECK ---
         if is_bad_aspect_ratio(width, height):
             logger.warning(f"Abnormal aspect ratio ({width/height:.2f}), skipping.")
-            return None, orig_format
-
-        # --- 3️⃣ COLOR VARIANCE CHECK ---
-        if is_low_color_variance(img):
-            logger.warning("Single-color / blank image detected, skipping.")
-            return None, orig_format
+            return (None, orig_format), None
 
-        # --- 4️⃣ OVER-COMPRESSION CHECK ---
-        file_size = len(response.content)
+        # --- 3️⃣ OVER-COMPRESSION CHECK ---
+        file_size = len(data)
         if is_overcompressed(file_size, width, height):
             logger.warning("Over-compressed / low quality image, skipping.")
+            return (None, orig_format), None
+
+        return None, (data, orig_format, width, height)
+    except Exception as e:
+        logger.error(f"Image download error: {e}")
+        return (None, None), None
+
+
+def convert_thumbnail(img_url, target_format, data, orig_format, width, height):
+    """Processing stage (CPU bound): decode, dedup/blank checks, downscale, encode and save"""
+    try:
+        # Open image with Pillow (pixels are decoded lazily)
+        img = Image.open(io.BytesIO(data), formats=SUPPORTED_IMAGE_FORMATS)
+
+        # JPEG: let libjpeg decode at 1/2..1/8 scale for the hash/variance checks
+        if img.format == 'JPEG':
+            img.draft('RGB', (512, 512))
+        drafted = img.size != (width, height)
+
+        # --- 4️⃣ COLOR VARIANCE CHECK (first decode, grayscale) ---
+        # Runs before hashing: both share the grayscale decode, and blank images need no hash
+        if is_low_color_variance(img):
+            logger.warning("Single-color / blank image detected, skipping.")
             return None, orig_format
 
         # --- 5️⃣ DUPLICATE CHECK ---
-        dup_filename = is_duplicate(img, target_format)
+        analysis_img = get_analysis_image(img)  # Kept for hit confirmation; img is replaced below
+        try:
+            img_hash = compute_image_hash(img)
+        except Exception:
+            img_hash = None
+        dup_filename = is_duplicate_by_hash(analysis_img, img_hash, width, height, target_format) if img_hash is not None else None
         if dup_filename:
-            logger.info(f"Same image already processed as {target_format} ({dup_filename}), reusing.")
+            logger.debug(f"Same image already processed as {target_format} ({dup_filename}), reusing.")
+            register_url_file(img_url, target_format, dup_filename)
             return dup_filename, orig_format
 
-        # --- 6️⃣ FORMAT CONVERSION ---
+        # Re-open for saving; JPEG decodes at the smallest scale that still covers max_size
+        max_size = BODY_MAX_SIZE if target_format == 'JPEG' else THUMB_MAX_SIZE
+        if drafted:
+            img = Image.open(io.BytesIO(data), formats=SUPPORTED_IMAGE_FORMATS)
+            img.draft('RGB', max_size)
+
+        # --- 6️⃣ DOWNSCALE (e-reader resolution, keeps aspect ratio) ---
+        if img.mode == 'P':
+            img = img.convert('RGBA')  # Palette images cannot be resampled smoothly
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+
+        # --- 7️⃣ FORMAT CONVERSION ---
         if target_format == 'JPEG':
             # Remove transparency (Alpha) - Add black background
             if img.mode in ('RGBA', 'P', 'LA'):
                 img = img.convert('RGBA')
-                new_img = Image.new("RGB", img.size, (0, 0, 0))
-                new_img.paste(img, mask=img.split()[3]) # 3 is alpha channel
-                img = new_img
+                background = Image.new("RGBA", img.size, (0, 0, 0, 255))
+                img = Image.alpha_composite(background, img).convert('RGB')
             else:
                 img = img.convert('RGB')
             ext = "jpg"
+            save_format, save_options = 'JPEG', JPEG_SAVE_OPTIONS
         else: # Default PNG
             if img.mode in ('RGBA', 'P'):
                 img = img.convert('RGBA')
+                save_format, save_options, ext = get_graphic_save_params()
             else:
                 img = img.convert('RGB')
-            ext = "png"
+                if is_photo_like(img):
+                    # Opaque photos: JPEG is much smaller and faster to encode than PNG
+                    save_format, save_options, ext = 'JPEG', PHOTO_SAVE_OPTIONS, "jpg"
+                else:
+                    save_format, save_options, ext = get_graphic_save_params()
         
         # Generate filename with UUID
         filename = f"{uuid.uuid4()}.{ext}"
         file_path = os.path.join(IMAGES_DIR, filename)
         
         # Save
-        img.save(file_path, target_format, optimize=True)
-        register_image_hash(img, filename, target_format)
-        logger.info(f"Image saved: {filename} ({target_format})")
+        img.save(file_path, save_format, **save_options)
+        if img_hash is not None:
+            register_image_hash_value(analysis_img, img_hash, width, height, filename, target_format)
+        register_url_file(img_url, target_format, filename)
+        logger.debug(f"Image saved: {filename} ({save_format})")
         
         return filename, orig_format
     except Exception as e:
         logger.error(f"Image processing error: {e}")
         return None, None
+
+
+def download_and_convert_thumbnail(img_url, target_format='PNG'):
+    """Download image, convert to specified format, save with UUID and return new path"""
+    result, source = fetch_thumbnail(img_url, target_format)
+    if result is not None:
+        return result
+    return convert_thumbnail(img_url, target_format, *source)
@@ -4,6 +4,11 @@ from src.config import INSTAPAPER_USER, INSTAPAPER_PASS, logger
 
 
 # --- INSTAPAPER API ---
+# Reused connection to the Instapaper API (keep-alive)
+SESSION = requests.Session()
+INSTAPAPER_TIMEOUT = 15  # Seconds (connect/read) - a hung request must not stall mail processing
+
+
 def send_to_instapaper(url, title):
     """Add a link using the Instapaper Simple API"""
     api_url = "https://www.instapaper.com/api/add"
@@ -17,7 +22,7 @@ def send_to_instapaper(url, title):
     
     logger.info(f"Sending API request: {url}")
     try:
-        response = requests.get(api_url, params=payload)
+        response = SESSION.get(api_url, params=payload, timeout=INSTAPAPER_TIMEOUT)
         
         if response.status_code == 201:
             logger.info(f"SUCCESS! Instapaper accepted: {title}")
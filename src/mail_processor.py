@@ -1,10 +1,11 @@
 import os
 import re
 import uuid
-import json
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 
+import orjson
 from imap_tools import MailBox, A
 
 from src.config import (
@@ -12,22 +13,57 @@ from src.config import (
     VDS_IP, WEB_PORT, TR_TZ, logger
 )
 from src.image_utils import (
-    seen_hashes, extract_meta_tag, extract_og_image,
-    download_and_convert_thumbnail, is_avatar_tag
+    extract_meta_tag, extract_og_image, is_avatar_tag,
+    download_and_convert_thumbnail, fetch_thumbnail, convert_thumbnail, save_url_cache
 )
-from src.cleanup import cleanup_old_articles
+from src.articles import invalidate_articles_cache, write_ready_article, index_article, article_ingest
 from src.instapaper import send_to_instapaper
-from src.utils import format_turkish_date
+from src.utils import format_turkish_date, write_file_atomic
+
+
+IMAGE_DOWNLOAD_WORKERS = 8  # Parallel image downloads per message
+IMAGE_CONVERT_WORKERS = os.cpu_count() or 2  # Parallel decode/encode (Pillow releases the GIL)
+IMG_RE = re.compile(r'<img[^>]+src=["\']([^"\']+)["\'][^>]*>', re.IGNORECASE)
+
+
+def prefetch_images(tasks, download_cache):
+    """
+    Download/convert (url, fmt) pairs concurrently into download_cache.
+    Downloads run on an I/O pool; each finished download is handed to a CPU-sized convert pool,
+    so decoding overlaps with the remaining transfers without oversubscribing the cores.
+    """
+    if not tasks:
+        return
+    with ThreadPoolExecutor(max_workers=min(IMAGE_DOWNLOAD_WORKERS, len(tasks))) as fetch_pool, \
+            ThreadPoolExecutor(max_workers=min(IMAGE_CONVERT_WORKERS, len(tasks))) as convert_pool:
+        fetches = {
+            fetch_pool.submit(fetch_thumbnail, url, target_format=fmt): (url, fmt)
+            for url, fmt in tasks
+        }
+        converts = {}
+        for future in as_completed(fetches):
+            url, fmt = fetches[future]
+            result, source = future.result()
+            if result is not None:
+                download_cache[(url, fmt)] = result
+            else:
+                converts[convert_pool.submit(convert_thumbnail, url, fmt, *source)] = (url, fmt)
+        for future in as_completed(converts):
+            download_cache[converts[future]] = future.result()
 
 
 def process_message(msg):
-    """Process incoming mail message, eagerly prepare images and create JSON mapping"""
-    # First clean up old articles
-    cleanup_old_articles()
+    """Process incoming mail message: store the article, then send its link to Instapaper"""
+    html_file = store_article(msg)
 
-    # Reset duplicate check for this article (prevents cross-article deletion errors)
-    seen_hashes.clear()
-    
+    # 5. Send to Instapaper (outside the ingest guard, so a slow API cannot hold up cleanup)
+    public_link = f"{VDS_IP}/read/{html_file}"
+    send_to_instapaper(public_link, msg.subject)
+
+
+@article_ingest()
+def store_article(msg):
+    """Eagerly prepare images, create the JSON mapping and save the article; returns its filename"""
     # 1. Determine filename and paths
     uuid_name = str(uuid.uuid4())
     html_file = f"{uuid_name}.html"
@@ -72,15 +108,21 @@ def process_message(msg):
     }
 
     # --- 🟢 PRE-SCAN: Detect Avatars and Small Icons ---
-    # Find all img tags in body and determine which ones are avatars
-    # These URLs will never be selected as thumbnails.
+    # Single regex pass over the body: (start, end, full_tag, url, is_avatar) per img tag.
+    # Avatar URLs will never be selected as thumbnails;
+    # non-avatar body images are collected for the parallel prefetch below.
+    img_matches = []
     avatar_url_blacklist = set()
-    all_img_matches = re.finditer(r'<img[^>]+src=["\']([^"\']+)["\'][^>]*>', content, re.IGNORECASE)
-    for match in all_img_matches:
+    prefetch_tasks = set()
+    for match in IMG_RE.finditer(content):
         full_tag = match.group(0)
         img_url = match.group(1)
-        if is_avatar_tag(full_tag):
+        is_avatar = is_avatar_tag(full_tag)
+        img_matches.append((match.start(), match.end(), full_tag, img_url, is_avatar))
+        if is_avatar:
             avatar_url_blacklist.add(img_url)
+        else:
+            prefetch_tasks.add((img_url, 'JPEG'))
     
     # Use subject as title if no og:title found
     if not mapping["og_title"]:
@@ -90,46 +132,46 @@ def process_message(msg):
     download_cache = {}
 
     def get_thumb(url, fmt='PNG'):
-        cache_key = f"{url}_{fmt}"
+        cache_key = (url, fmt)
         if cache_key not in download_cache:
             download_cache[cache_key] = download_and_convert_thumbnail(url, target_format=fmt)
         return download_cache[cache_key]
 
     # 3.2. og:image detection
     og_url = extract_og_image(content)
+    if og_url and og_url not in avatar_url_blacklist:
+        prefetch_tasks.add((og_url, 'PNG'))
+
+    # Download og:image + body images concurrently; the steps below become cache lookups
+    prefetch_images(prefetch_tasks, download_cache)
     
     # A. Detect og:image and process as PNG
     if og_url:
         if og_url in avatar_url_blacklist:
-            logger.info(f"Skipping og:image (in avatar blacklist): {og_url}")
+            logger.debug(f"Skipping og:image (in avatar blacklist): {og_url}")
         else:
-            logger.info(f"og:image detected, processing as PNG: {og_url}")
+            logger.debug(f"og:image detected, processing as PNG: {og_url}")
             mapping["og_image_local"], _ = get_thumb(og_url, 'PNG')
 
     # B. If no og:image, fallback (select from body)
     if not mapping["og_image_local"]:
         logger.warning("No meta image or download failed, searching body for images...")
-        img_tags = re.findall(r'<img[^>]+src=["\']([^"\']+)["\'][^>]*>', content, re.IGNORECASE)
-        
         # Find best cover image (first image not in blacklist)
-        for img_url in img_tags:
+        for _, _, _, img_url, _ in img_matches:
             if img_url in avatar_url_blacklist:
                 continue # Don't use avatars as cover
                 
             saved_png, _ = get_thumb(img_url, 'PNG')
             if saved_png:
                 mapping["og_image_local"] = saved_png
-                logger.info(f"Fallback thumbnail selected: {saved_png}")
+                logger.debug(f"Fallback thumbnail selected: {saved_png}")
                 break
 
     # 3.3. Process all body images and clean up PNGs
-    def body_img_processor(match):
-        full_tag = match.group(0)
-        img_url = match.group(1)
-        
+    def body_img_processor(full_tag, img_url, is_avatar):
         # --- 🟢 DISPLAY-SIZE AND AVATAR CHECK (HTML Attribute based) ---
-        if is_avatar_tag(full_tag):
-            logger.info(f"Avatar/Icon detected, removing: {img_url}")
+        if is_avatar:
+            logger.debug(f"Avatar/Icon detected, removing: {img_url}")
             return ""
 
         # --- 🔵 FILE SIZE AND FORMAT CHECK (Download/Processing based) ---
@@ -139,51 +181,121 @@ def process_message(msg):
         if not saved_jpg:
             # Does not meet standards (below 100px) or download/open error
             if orig_fmt:
-                logger.info(f"Small image ({orig_fmt}) removed: {img_url}")
+                logger.debug(f"Small image ({orig_fmt}) removed: {img_url}")
                 return "" # Remove small images from HTML regardless of format
             return full_tag # If download error, keep original link (may be temporary)
             
         mapping["body_mappings"][img_url] = saved_jpg
         return full_tag
 
-    # Update content (re.sub populates mapping and removes small PNGs)
-    # Note: re.sub callback runs sequentially, mapping["body_mappings"] will be populated.
-    content = re.sub(r'<img[^>]+src=["\']([^"\']+)["\'][^>]*>', body_img_processor, content, flags=re.IGNORECASE)
+    # Rebuild content from the pre-scan matches (populates mapping and removes small images)
+    parts = []
+    cursor = 0
+    for start, end, full_tag, img_url, is_avatar in img_matches:
+        parts.append(content[cursor:start])
+        parts.append(body_img_processor(full_tag, img_url, is_avatar))
+        cursor = end
+    parts.append(content[cursor:])
+    content = ''.join(parts)
 
-    # 4. Save Files (HTML original, Mapping JSON)
+    # 4. Save Files (Mapping JSON, HTML original, read-ready copy)
+    # Each file is written atomically. The HTML makes the article visible, so the JSON goes first;
+    # the read-ready copy goes last so it is newer than both sources (/read/ would rebuild it otherwise)
     try:
-        # Save HTML
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(content)
-        
         # Save JSON
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(mapping, f, ensure_ascii=False, indent=4)
-            
+        write_file_atomic(json_path, orjson.dumps(mapping))
+
+        # Save HTML
+        write_file_atomic(html_path, content.encode('utf-8'))
+
+        # Save read-ready copy (served statically by /read/)
+        write_ready_article(html_file, content, mapping)
+
+        invalidate_articles_cache()
+        index_article(uuid_name, mapping)
         logger.info(f"Article and mapping saved: {uuid_name}")
     except Exception as e:
         logger.error(f"Save error: {e}")
 
-    # 5. Send to Instapaper
-    public_link = f"{VDS_IP}/read/{html_file}"
-    send_to_instapaper(public_link, msg.subject)
+    # One URL cache write per message instead of one per saved image
+    save_url_cache()
+    return html_file
 
 
 # --- MAIL LISTENER (IMAP) ---
+IMAP_FETCH_BULK = 100  # Messages per FETCH command (larger batches hit server request-size limits)
+IMAP_IDLE_TIMEOUT = 29 * 60  # Servers end IDLE after ~30 minutes, so re-issue it before that
+MAIL_POLL_INTERVAL = 60  # Fallback poll interval for servers without IDLE / after errors
+MAIL_WORKERS = 4  # Messages processed concurrently (work is dominated by image downloads)
+
+_mailbox = None  # Logged-in MailBox reused across polls
+
+
+def get_mailbox():
+    """Return the shared logged-in MailBox, reconnecting if the connection was dropped"""
+    global _mailbox
+    if _mailbox is not None:
+        try:
+            _mailbox.client.noop()  # Keepalive / liveness check
+            return _mailbox
+        except Exception as e:
+            logger.warning(f"IMAP connection lost ({e}), reconnecting...")
+            close_mailbox()
+
+    _mailbox = MailBox(IMAP_SERVER).login(EMAIL_USER, EMAIL_PASS)
+    logger.info("IMAP login successful.")
+    return _mailbox
+
+
+def close_mailbox():
+    """Log out and drop the shared MailBox (next get_mailbox() reconnects)"""
+    global _mailbox
+    if _mailbox is not None:
+        try:
+            _mailbox.logout()
+        except Exception:
+            pass
+        _mailbox = None
+
+
+def wait_for_mail(mailbox):
+    """Block until the server reports a mailbox change (IMAP IDLE), or poll if IDLE is unsupported"""
+    if 'IDLE' in mailbox.client.capabilities:
+        mailbox.idle.wait(timeout=IMAP_IDLE_TIMEOUT)
+    else:
+        time.sleep(MAIL_POLL_INTERVAL)
+
+
+def process_messages(messages):
+    """Process a batch of fetched messages concurrently"""
+    with ThreadPoolExecutor(max_workers=min(MAIL_WORKERS, len(messages))) as executor:
+        futures = {}
+        for msg in messages:
+            logger.info(f"New Mail: {msg.subject}")
+            futures[executor.submit(process_message, msg)] = msg
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Message processing error ({futures[future].subject}): {e}")
+
+
 def check_mail_loop():
     logger.info(f"Listening active. Broadcasting on {VDS_IP}:{WEB_PORT}...")
     while True:
         try:
-            with MailBox(IMAP_SERVER).login(EMAIL_USER, EMAIL_PASS) as mailbox:
-                for msg in mailbox.fetch(A(seen=False), mark_seen=True):
-                    logger.info(f"New Mail: {msg.subject}")
-                    
-                    # Process the message
-                    process_message(msg)
-                    
-                    
+            mailbox = get_mailbox()
+            # Pull every unseen message first, then process them in parallel
+            messages = list(mailbox.fetch(A(seen=False), mark_seen=True, bulk=IMAP_FETCH_BULK))
+            if messages:
+                process_messages(messages)
+            else:
+                logger.info("Mail check complete, no new mail. Waiting for new mail...")
+
+            # Sleep until the server pushes a change instead of polling every minute
+            wait_for_mail(mailbox)
         except Exception as e:
             logger.error(f"Mail check error: {e}")
-        
-        logger.info("Mail check complete, no new mail. Rechecking in 60 seconds.")
-        time.sleep(60)
+            # Drop the connection; it is re-established on the next tick
+            close_mailbox()
+            time.sleep(MAIL_POLL_INTERVAL)
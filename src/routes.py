@@ -1,20 +1,22 @@
 import os
-import re
-import json
+from functools import lru_cache
 
 from flask import send_from_directory, abort, render_template
+from waitress import serve
 
-from src.config import app, ARTICLES_DIR, IMAGES_DIR, DATA_DIR, UUID_PATTERN, VDS_IP, WEB_PORT, logger
-from src.utils import format_turkish_date, extract_snippet_from_html
+from src.config import app, ARTICLES_DIR, IMAGES_DIR, DATA_DIR, READY_DIR, VDS_IP, WEB_PORT, WEB_THREADS, is_article_filename, logger
+from src.utils import format_turkish_date
+from src.articles import get_articles, get_ready_filename, ensure_ready_article, load_mapping, get_article_snippet
 
 
 # --- WEB SERVER (FLASK) ---
+ARTICLE_MAX_AGE = 3600  # Cache-Control max-age (seconds) for /read/ responses
 
 @app.route('/read/<filename>')
 def serve_article(filename):
     """Serve the generated HTML file - with security checks"""
     # Security: Only allow UUID-formatted .html files
-    if not UUID_PATTERN.match(filename):
+    if not is_article_filename(filename):
         abort(403)  # Invalid filename format
     
     # Security: Prevent path traversal
@@ -23,135 +25,28 @@ def serve_article(filename):
     
     # Security: Whitelist check - get existing files and compare
     try:
-        existing_articles = set(os.listdir(ARTICLES_DIR))
-        if filename not in existing_articles:
-            abort(404)  # File not found
+        existing_articles, _ = get_articles()
     except Exception:
         abort(500)
+    if filename not in existing_articles:
+        abort(404)  # File not found
     
-    # Verify file is actually in the articles directory
-    file_path = os.path.join(ARTICLES_DIR, filename)
-    if not os.path.abspath(file_path).startswith(os.path.abspath(ARTICLES_DIR)):
-        abort(403)
-    
-    # --- READ AND MODIFY FILE ---
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        uuid_name = filename.replace('.html', '')
-        json_path = os.path.join(DATA_DIR, f"{uuid_name}.json")
-        mapping = {}
-        
-        if os.path.exists(json_path):
-            try:
-                with open(json_path, 'r', encoding='utf-8') as f:
-                    mapping = json.load(f)
-            except Exception:
-                pass
-
-        # --- PUBLIC LINK INJECTION ---
-        public_url = f"{VDS_IP}/read/{filename}"
-
-        # --- EMOJI DETECTION AND WRAPPING ---
-        # Emoji regex (Common ranges)
-        emoji_pattern = re.compile(
-            "["
-            "\U0001f600-\U0001f64f"  # emoticons
-            "\U0001f300-\U0001f5ff"  # symbols & pictographs
-            "\U0001f680-\U0001f6ff"  # transport & map symbols
-            "\U0001f1e0-\U0001f1ff"  # flags (iOS)
-            "\U00002702-\U000027b0"  # dingbats
-            "\U000024c2-\U0001f251"
-            "]+", flags=re.UNICODE
-        )
-        # content = emoji_pattern.sub(lambda m: f'<span class="emoji">{m.group(0)}</span>', content)
-        # logger.info("Emojis detected and marked.")
-
-        # --- DIV TO P REPLACEMENT (E-Reader Compatibility) ---
-        content = content.replace('<div', '<p').replace('</div', '</p')
-        logger.info("DIV tags replaced with P tags.")
-
-        # --- DYNAMIC OG METADATA INJECTION (VIA JSON) ---
-        if mapping:
-            og_tags = []
-            
-            # 1. og:image
-            og_local = mapping.get('og_image_local')
-            if og_local:
-                local_img_url = f"{VDS_IP}/images/{og_local}"
-                og_tags.append(f'<meta property="og:image" content="{local_img_url}">')
-                og_tags.append(f'<meta name="twitter:image" content="{local_img_url}">')
-                logger.info(f"og:image injected: {og_local}")
-
-            # 2. Other Metadata
-            for key in ['og:title', 'og:description', 'og:type', 'og:url']:
-                val = mapping.get(key.replace(':', '_'))
-                if val:
-                    og_tags.append(f'<meta property="{key}" content="{val}">')
-            
-            if og_tags:
-                og_html = "\n".join(og_tags)
-                # Clean existing og/twitter tags to prevent conflicts
-                content = re.sub(r'<meta[^>]+property=["\']og:[^>]+>', '', content, flags=re.IGNORECASE)
-                content = re.sub(r'<meta[^>]+name=["\']twitter:[^>]+>', '', content, flags=re.IGNORECASE)
-                
-                # Injection
-                if '<head>' in content:
-                    content = content.replace('<head>', f'<head>{og_html}', 1)
-                elif '<html>' in content:
-                    content = content.replace('<html>', f'<html><head>{og_html}</head>', 1)
-                else:
-                    content = f'{og_html}' + content
-
-            # 3. Body Image Replacement (Existing logic)
-            body_maps = mapping.get('body_mappings', {})
-            for original_url, local_name in body_maps.items():
-                local_url = f"{VDS_IP}/images/{local_name}"
-                content = content.replace(f'src="{original_url}"', f'src="{local_url}"')
-                content = content.replace(f"src='{original_url}'", f"src='{local_url}'")
-            if body_maps:
-                logger.info(f"{len(body_maps)} body image(s) replaced with local links.")
-
-        # --- FOOTER/HEADER LINK INJECTION ---
-
-        # Read mail date from JSON
-        date_str = mapping.get('mail_date', '')
-        
-        header_html = f'''
-        <p style="
-            font-style: italic;
-            color: #666;
-            margin: 10px 0;
-            font-size: 0.9em;
-        ">
-            <a href="{public_url}" target="_blank" style="color: #0066cc; text-decoration: underline;">makaleyi web sitesinde görüntüle</a>
-            <span style="margin-left: 8px; color: #999; font-size: 0.85em;">({date_str})</span>
-        </p>
-        '''
-
-        # Injection Logic:
-        # 1. Find first </h2> tag and add after it
-        # 2. If no H2, find first <p> tag and add before it
-        # 3. If none found, add to body start
-
-        if '</h2>' in content:
-            content = re.sub(r'(</h2>)', r'\1' + header_html, content, count=1, flags=re.IGNORECASE)
-            logger.info("Link added after H2.")
-        elif '<p' in content:
-            content = re.sub(r'(<p)', header_html + r'\1', content, count=1, flags=re.IGNORECASE)
-            logger.info("Link added before first P.")
-        elif '<body>' in content:
-            content = content.replace('<body>', f'<body>{header_html}', 1)
-        else:
-            content = header_html + content
-
-        return content
+    # No abspath check needed: the UUID allow-list above cannot name a path
+    # outside ARTICLES_DIR, and send_from_directory joins safely.
 
+    # --- SERVE READ-READY COPY ---
+    # Rewrites are applied once at ingest; older or since-edited articles are re-rendered on read
+    ready_file = get_ready_filename(filename)
+    try:
+        ensure_ready_article(filename)
     except Exception as e:
         logger.error(f"Read error: {e}")
         abort(500)
 
+    # ETag/Last-Modified come from the ready file, which is rebuilt whenever the
+    # article or its mapping changes; clients revalidate with If-None-Match (304)
+    return send_from_directory(READY_DIR, ready_file, max_age=ARTICLE_MAX_AGE)
+
 
 @app.route('/images/<filename>')
 def serve_image(filename):
@@ -159,94 +54,104 @@ def serve_image(filename):
     return send_from_directory(IMAGES_DIR, filename)
 
 
+_folder_stats_cache = {}  # {folder_path: (mtime_ns, (file_count, total_size))}
+
+
 def get_folder_stats(folder_path):
-    """Calculate folder statistics: file count and total size"""
+    """Calculate folder statistics: file count and total size (re-scanned only when the folder changes)"""
+    try:
+        mtime = os.stat(folder_path).st_mtime_ns
+    except Exception:
+        return 0, 0
+    cached = _folder_stats_cache.get(folder_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
     total_size = 0
     file_count = 0
     try:
-        for f in os.listdir(folder_path):
-            fp = os.path.join(folder_path, f)
-            if os.path.isfile(fp):
-                total_size += os.path.getsize(fp)
-                file_count += 1
+        with os.scandir(folder_path) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    total_size += entry.stat(follow_symlinks=False).st_size
+                    file_count += 1
     except Exception:
         pass
+    _folder_stats_cache[folder_path] = (mtime, (file_count, total_size))
     return file_count, total_size
 
 
+# Size units for format_size
+_KB = 1 << 10
+_MB = 1 << 20
+_GB = 1 << 30
+
+
+@lru_cache(maxsize=64)
 def format_size(size_bytes):
     """Convert bytes to human-readable format"""
-    if size_bytes < 1024:
+    if size_bytes < _KB:
         return f"{size_bytes} B"
-    elif size_bytes < 1024 * 1024:
-        return f"{size_bytes / 1024:.1f} KB"
-    elif size_bytes < 1024 * 1024 * 1024:
-        return f"{size_bytes / (1024 * 1024):.1f} MB"
+    elif size_bytes < _MB:
+        return f"{size_bytes / _KB:.1f} KB"
+    elif size_bytes < _GB:
+        return f"{size_bytes / _MB:.1f} MB"
     else:
-        return f"{size_bytes / (1024 * 1024 * 1024):.1f} GB"
+        return f"{size_bytes / _GB:.1f} GB"
 
 
 @app.route('/')
 def index():
     """Main page listing articles - Dark Mode"""
     try:
-        # Get articles and sort by creation time (newest first)
+        # Get articles sorted by creation time (newest first)
         files = []
-        for f in os.listdir(ARTICLES_DIR):
-            if f.endswith('.html') and UUID_PATTERN.match(f):
-                path = os.path.join(ARTICLES_DIR, f)
-                
-                # Fetch metadata from corresponding JSON
-                uuid_name = f.replace('.html', '')
-                json_path = os.path.join(DATA_DIR, f"{uuid_name}.json")
-                
-                title = f
-                description = ""
-                thumbnail = None
-                date_str = ""
-                
-                if os.path.exists(json_path):
-                    try:
-                        with open(json_path, 'r', encoding='utf-8') as jf:
-                            mapping = json.load(jf)
-                            
-                        # Use mapped title or fallback
-                        title = mapping.get('og_title') or f
-                        # Use mapped description
-                        description = mapping.get('og_description') or ""
-                        # Use local mapped thumbnail
-                        thumbnail = mapping.get('og_image_local')
-                        # Mapped date
-                        date_str = mapping.get('mail_date', "")
-                    except Exception:
-                        pass
-                
-                # Fallback Description logic
-                if not description:
-                    try:
-                        with open(path, 'r', encoding='utf-8') as hf:
-                            content = hf.read()
-                            description = extract_snippet_from_html(content, max_length=150)
-                    except Exception:
-                        pass
-                        
-                # Ensure date is populated
-                if not date_str:
-                    import datetime
-                    from src.config import TR_TZ
-                    date_str = format_turkish_date(datetime.datetime.now(TR_TZ))
-
-                files.append({
-                    'name': f,
-                    'time': os.path.getctime(path),
-                    'display_name': f,
-                    'title': title,
-                    'description': description,
-                    'thumbnail': thumbnail,
-                    'date_str': date_str
-                })
-        
-        files.sort(key=lambda x: x['time'], reverse=True)
+        _, sorted_articles = get_articles()
+        for f in sorted_articles:
+            # Fetch metadata from corresponding JSON (cached until the file changes)
+            uuid_name = f.replace('.html', '')
+            
+            title = f
+            description = ""
+            thumbnail = None
+            date_str = ""
+            
+            try:
+                mapping = load_mapping(uuid_name)
+            except Exception:
+                mapping = None
+
+            if mapping is not None:
+                # Use mapped title or fallback
+                title = mapping.get('og_title') or f
+                # Use mapped description
+                description = mapping.get('og_description') or ""
+                # Use local mapped thumbnail
+                thumbnail = mapping.get('og_image_local')
+                # Mapped date
+                date_str = mapping.get('mail_date', "")
+            
+            # Fallback Description logic
+            if not description:
+                try:
+                    description = get_article_snippet(f, max_length=150)
+                except Exception:
+                    pass
+                    
+            # Ensure date is populated
+            if not date_str:
+                import datetime
+                from src.config import TR_TZ
+                date_str = format_turkish_date(datetime.datetime.now(TR_TZ))
+
+            files.append({
+                'name': f,
+                'display_name': f,
+                'title': title,
+                'description': description,
+                'thumbnail': thumbnail,
+                'date_str': date_str
+            })
 
         # Folder statistics
         articles_count, articles_size = get_folder_stats(ARTICLES_DIR)
@@ -270,4 +175,5 @@ def index():
 
 def run_web_server():
     logger.info(f"Web server started: {VDS_IP}:{WEB_PORT}")
-    app.run(host='0.0.0.0', port=WEB_PORT, debug=False, use_reloader=False)
+    # Production WSGI server: /read/ and /images/ requests are served concurrently
+    serve(app, host='0.0.0.0', port=WEB_PORT, threads=WEB_THREADS)
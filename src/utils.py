@@ -1,6 +1,18 @@
 from datetime import datetime
 import locale
+import os
 import re
+import tempfile
+
+# Turkish month and day names
+TR_MONTHS = (
+    "", "ocak", "şubat", "mart", "nisan", "mayıs", "haziran",
+    "temmuz", "ağustos", "eylül", "ekim", "kasım", "aralık"
+)
+TR_DAYS = (
+    "Pazartesi", "Salı", "Çarşamba", "Perşembe", "Cuma", "Cumartesi", "Pazar"
+)
+
 
 def format_turkish_date(dt):
     """
@@ -10,23 +22,20 @@ def format_turkish_date(dt):
     if not dt:
         return ""
         
-    # Turkish month and day names
-    months = [
-        "", "ocak", "şubat", "mart", "nisan", "mayıs", "haziran",
-        "temmuz", "ağustos", "eylül", "ekim", "kasım", "aralık"
-    ]
-    days = [
-        "Pazartesi", "Salı", "Çarşamba", "Perşembe", "Cuma", "Cumartesi", "Pazar"
-    ]
-    
     day_num = dt.day
-    month_name = months[dt.month]
+    month_name = TR_MONTHS[dt.month]
     year = dt.year
-    day_name = days[dt.weekday()]
-    time_str = dt.strftime("%H.%M")
+    day_name = TR_DAYS[dt.weekday()]
+    time_str = f"{dt.hour:02d}.{dt.minute:02d}"
     
     return f"{day_num} {month_name} {year} {day_name} Saat {time_str}"
 
+# First <p>...</p> block (lazy: the scan stops at the first closing tag) and inner tags
+P_BLOCK_RE = re.compile(r'<p[^>]*>(.*?)</p>', re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r'<[^>]+>')
+SNIPPET_SLACK = 4  # Raw paragraph chars examined per snippet char
+
+
 def extract_snippet_from_html(html_content, max_length=150):
     """
     Extracts a plain text snippet from the first <p> tag in the HTML.
@@ -36,19 +45,50 @@ def extract_snippet_from_html(html_content, max_length=150):
         return ""
     
     # Find the first <p>...</p> block
-    match = re.search(r'<p[^>]*>(.*?)</p>', html_content, re.IGNORECASE | re.DOTALL)
+    match = P_BLOCK_RE.search(html_content)
     if not match:
         return ""
         
+    # Only the head of a long paragraph can reach the snippet (the slack covers inline tags)
+    start, end = match.span(1)
+    pre_truncated = end - start > max_length * SNIPPET_SLACK
+    raw_text = html_content[start:min(end, start + max_length * SNIPPET_SLACK)]
+    if pre_truncated:
+        # Drop a tag cut in half by the slice
+        tag_start = raw_text.rfind('<')
+        if tag_start > raw_text.rfind('>'):
+            raw_text = raw_text[:tag_start]
+
     # Strip inner HTML tags from the paragraph
-    raw_text = match.group(1)
-    clean_text = re.sub(r'<[^>]+>', '', raw_text)
+    clean_text = TAG_RE.sub('', raw_text)
     
     # Clean up whitespace and newlines
-    clean_text = re.sub(r'\s+', ' ', clean_text).strip()
+    clean_text = ' '.join(clean_text.split())
+
+    # Tags (e.g. a long link URL) used up the slack: fall back to the whole paragraph
+    if pre_truncated and len(clean_text) <= max_length:
+        clean_text = ' '.join(TAG_RE.sub('', html_content[start:end]).split())
+        pre_truncated = False
     
     # Truncate if necessary
-    if len(clean_text) > max_length:
+    if pre_truncated or len(clean_text) > max_length:
         return clean_text[:max_length].strip() + "..."
     
     return clean_text
+
+def write_file_atomic(path, data):
+    """Write bytes to path via a temp file + rename, so readers never see a partial file"""
+    # Unique temp name per call: concurrent writers of the same path must not share it
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        os.fchmod(fd, 0o644)  # mkstemp creates 0600 files
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise